@@ -31,6 +31,7 @@ setup(
     py_modules=[splitext(basename(path))[0] for path in glob("src/*.py")],
     install_requires=[
         "pyserial",
+        "numpy",
     ],
     classifiers=[
         "Programming Language :: Python :: 3",
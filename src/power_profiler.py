@@ -1,12 +1,16 @@
 import time
-import csv
 import datetime
 import logging
-from threading import Event, RLock, Thread
+import math
+import queue
+import numpy as np
+from threading import Condition, Event, Lock, Thread
 from ppk2_api.ppk2_api import PPK2_MP as PPK2_API
 
 logger = logging.getLogger(__name__)
 
+SAMPLE_RATE_HZ = 100000  # the PPK2 takes 100k samples per second
+
 class PowerProfiler():
     def __init__(self, serial_port=None, source_voltage_mV=3300, filename=None, source_meter=True, fetch_interval_s=0.1):
         """Initialize PPK2 power profiler with serial.
@@ -14,20 +18,24 @@ class PowerProfiler():
         Keyword arguments:
         serial_port -- the name of the serial port use to access the PPK2. If None, the port is detected automatically.
         source_voltage_mV -- the output voltage in mV the source meter is set to initially.
-        filename -- the path to a CSV file. If not None, this file will be created and the collected data is written to it whenever stop_measurement() is called.
+        filename -- the path to a CSV file. If not None, this file will be created and the collected data is written to it by a background thread while measuring.
         source_meter -- if set to True, then the device is operated in source meter mode. If set to false, ampere meter mode is used.
         fetch_interval -- the number of seconds betweem fetching data from the measurement process. The measurement process keeps up to 10 seconds of data, so it is not necessarry to use a very low value here.
         """
-        self.measuring = None
         self.measurement_thread = None
-        # measure_lock is taken by the measurement thread whenever it is fetching data and by the main thread whenever measuring is paused
-        # it is also used to protect the member variables that are accessed both by the main thread and the measurement thread
-        self.measure_lock = RLock()
-        self.measure_lock.acquire()
+        # _dev_lock serializes access to the PPK2, the measurement thread holds it whenever it is fetching data
+        # _data_lock protects the measurement buffer, which is accessed both by the main thread and the measurement thread
+        # when both are needed, _dev_lock is always taken first
+        self._dev_lock = Lock()
+        self._data_lock = Lock()
+        # _running is set while measuring, the measurement thread waits for it before fetching data so no serial traffic happens in between measurements
+        self._running = Event()
+        # _wakeup is notified whenever _running or stop is set, the measurement thread waits on it while not measuring
+        self._wakeup = Condition()
 
         self.fetch_interval = fetch_interval_s
 
-        # stop is a flag which is used to signal to the 
+        # stop is a flag which is used to signal to the measurement thread that it should exit
         self.stop = Event()
         self.ppk2 = None
 
@@ -63,8 +71,9 @@ class PowerProfiler():
 
             logger.debug("Set power profiler source voltage: %s mV", self.source_voltage_mV)
 
-            self.measuring = False
-            self.current_measurements = []
+            # current measurements in uA are stored in a growable float32 buffer - only the first _len values are valid
+            # running statistics of the current measurements are updated whenever samples are appended
+            self._reset_samples()
 
             # local variables used to calculate power consumption
             self.measurement_start_time = None
@@ -72,31 +81,81 @@ class PowerProfiler():
 
             time.sleep(1)
 
-            self.measurement_thread = Thread(target=self.measurement_loop, daemon=True)
-            self.measurement_thread.start()
-
             # write to csv
             self.filename = filename
+            self._csv_file = None
+            self._writer_thread = None
+            self._writer_error = None  # set by the writer thread if writing fails, no more batches are queued then
             if self.filename is not None:
-                with open(self.filename, 'w', newline='') as file:
-                    writer = csv.writer(file)
-                    row = []
-                    for key in ["ts", "avg1000"]:
-                        row.append(key)
-                    writer.writerow(row)
-
-    def write_csv_rows(self, samples):
-        """Write csv row"""
-        with open(self.filename, 'a', newline='') as file:
-            writer = csv.writer(file)
-            for sample in samples:
-                row = [datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S.%f'), sample]
-                writer.writerow(row)
+                # the file is kept open for the lifetime of the profiler and closed in delete_power_profiler()
+                self._csv_file = open(self.filename, 'w', newline='')
+                self._csv_file.write("ts,avg1000\r\n")
+
+                # the measurement thread queues (samples, start time, sample index) batches, None stops the writer thread
+                # the queue holds about 10 seconds of batches at the default fetch interval, if the writer falls behind the measurement thread waits for it
+                self._write_q = queue.Queue(maxsize=100)
+                # cleared while the measurement thread holds a batch that it has taken under _dev_lock but not queued yet
+                self._batch_queued = Event()
+                self._batch_queued.set()
+                self._writer_thread = Thread(target=self._writer_loop, daemon=True)
+                self._writer_thread.start()
+
+            self.measurement_thread = Thread(target=self.measurement_loop, daemon=True)
+            self.measurement_thread.start()
+
+    def _format_csv_rows(self, samples, start_time, first_index):
+        """Format csv rows, the timestamps are derived from the measurement start time, the index of the first sample and the sample rate"""
+        start = datetime.datetime.fromtimestamp(start_time)
+        sample_period_us = 1000000 // SAMPLE_RATE_HZ
+        timestamps = []
+        # offsets of the samples from the start of the second the measurement started in
+        offset_us = start.microsecond + first_index * sample_period_us
+        end_us = offset_us + len(samples) * sample_period_us
+        while offset_us < end_us:
+            seconds, microsecond = divmod(offset_us, 1000000)
+            # the part up to the second is the same for all samples within a second, so strftime is only needed once for them
+            prefix = (start.replace(microsecond=0) + datetime.timedelta(seconds=seconds)).strftime('%d-%m-%Y %H:%M:%S.')
+            count = -(-(min(end_us, (seconds + 1) * 1000000) - offset_us) // sample_period_us)
+            timestamps += ["%s%06d" % (prefix, us) for us in range(microsecond, microsecond + count * sample_period_us, sample_period_us)]
+            offset_us += count * sample_period_us
+        # the rows are formatted into a single string, the csv module would handle them one by one
+        return "".join(map("{},{!r}\r\n".format, timestamps, np.asarray(samples).tolist()))
+
+    def write_csv_rows(self, samples, start_time, first_index=0):
+        """Write csv rows"""
+        self._csv_file.write(self._format_csv_rows(samples, start_time, first_index))
+
+    def _writer_loop(self):
+        """Write the queued sample batches to the csv file, will run in a thread"""
+        while True:
+            batches = [self._write_q.get()]
+            # take everything that is queued already and write it at once
+            while batches[-1] is not None:
+                try:
+                    batches.append(self._write_q.get_nowait())
+                except queue.Empty:
+                    break
+
+            # after an error the remaining batches are only drained, so the measurement thread never blocks on a full queue
+            samples_batches = [batch for batch in batches if batch is not None]
+            if samples_batches and self._writer_error is None:
+                try:
+                    self._csv_file.write("".join(self._format_csv_rows(*batch) for batch in samples_batches))
+                    self._csv_file.flush()
+                except Exception as e:
+                    logger.error("Error writing to %s, no more data of this measurement is written to it: %s", self.filename, e)
+                    self._writer_error = e
+            for _ in batches:
+                self._write_q.task_done()
+            if batches[-1] is None:
+                return
 
     def delete_power_profiler(self):
         """Join thread"""
         self.stop.set()
-        self.stop_measuring()
+        with self._wakeup:
+            self._wakeup.notify_all()  # wake up the measurement thread if it is waiting for a measurement
+        self._stop_measuring()  # a csv writer error was logged already, so it isn't raised here
 
         logger.debug("Deleting power profiler")
 
@@ -105,11 +164,25 @@ class PowerProfiler():
             self.measurement_thread.join()
             self.measurement_thread = None
 
+        if self._writer_thread:
+            logger.debug("Joining csv writer thread")
+            self._write_q.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+
         if self.ppk2:
             logger.debug("Disabling ppk2 power")
             self.disable_power()
             del self.ppk2
 
+        if self._csv_file is not None:
+            logger.debug("Closing csv file")
+            try:
+                self._csv_file.close()
+            except OSError as e:
+                logger.error("Error closing %s: %s", self.filename, e)
+            self._csv_file = None
+
         logger.debug("Deleted power profiler")
 
     def discover_port(self):
@@ -119,13 +192,16 @@ class PowerProfiler():
             ppk2_port = ppk2s_connected[0]
             logger.debug('Found PPK2 at %s', ppk2_port)
             return ppk2_port
+        elif len(ppk2s_connected) == 0:
+            logger.warning("No connected PPK2 found")
+            return None
         else:
-            logger("Too many connected PPK2s: %s", ppk2s_connected)
+            logger.warning("Too many connected PPK2s: %s", ppk2s_connected)
             return None
 
     def enable_power(self):
         """Enable ppk2 power"""
-        with self.measure_lock:
+        with self._dev_lock:
             if self.ppk2:
                 self.ppk2.toggle_DUT_power("ON")
                 return True
@@ -133,14 +209,14 @@ class PowerProfiler():
 
     def disable_power(self):
         """Disable ppk2 power"""
-        with self.measure_lock:
+        with self._dev_lock:
             if self.ppk2:
                 self.ppk2.toggle_DUT_power("OFF")
                 return True
             return False
 
     def set_source_voltage(self, voltage_mV):
-        with self.measure_lock:
+        with self._dev_lock:
             if self.ppk2:
                 assert self.ppk2.vdd_low <= voltage_mV <= self.ppk2.vdd_high, f"Voltage must be in range [{self.ppk2.vdd_low}:self.ppk2.vdd_high] mV"
                 self.ppk2.set_source_voltage(voltage_mV)
@@ -150,7 +226,7 @@ class PowerProfiler():
         
     def use_source_meter(self):
         """Switch to source meter mode"""
-        with self.measure_lock:
+        with self._dev_lock:
             if self.ppk2:
                 self.ppk2.use_source_meter()
                 return True
@@ -158,7 +234,7 @@ class PowerProfiler():
 
     def use_ampere_meter(self):
         """Switch to source meter mode"""
-        with self.measure_lock:
+        with self._dev_lock:
             if self.ppk2:
                 self.ppk2.use_ampere_meter()
                 return True
@@ -166,80 +242,157 @@ class PowerProfiler():
 
     def measurement_loop(self):
         """Endless measurement loop will run in a thread"""
-        while True and not self.stop.is_set():
-            with self.measure_lock:
-                read_data = self.ppk2.get_data()
-                if read_data != b'':
-                    samples, raw_digital = self.ppk2.get_samples(read_data)
-                    self.current_measurements += samples  # can easily sum lists, will append individual data
-            time.sleep(self.fetch_interval)
+        # data is fetched every fetch_interval seconds measured from when the previous fetch was due, not from when it finished
+        next_fetch = time.monotonic() + self.fetch_interval
+        while not self.stop.wait(max(0, next_fetch - time.monotonic())):  # returns immediately when stop is set
+            if not self._running.is_set():
+                # sleep here while not measuring
+                with self._wakeup:
+                    self._wakeup.wait_for(lambda: self._running.is_set() or self.stop.is_set())
+                if self.stop.is_set():
+                    return
+                next_fetch = time.monotonic()
+            next_fetch += self.fetch_interval
+            batch = None
+            with self._dev_lock:
+                # stop_measuring() may have been called while waiting for the lock
+                if self._running.is_set() and not self.stop.is_set():
+                    read_data = self.ppk2.get_data()
+                    if read_data != b'':
+                        samples, raw_digital = self.ppk2.get_samples_array(read_data)
+                        with self._data_lock:
+                            first_index = self._len
+                            self._append_samples(samples)
+                        if self._csv_file is not None and self._writer_error is None and len(samples) > 0:
+                            batch = (samples, self.measurement_start_time, first_index)
+                            self._batch_queued.clear()
+            # queued outside of _dev_lock, so a full queue doesn't block stop_measuring() and the other device calls
+            if batch is not None:
+                self._write_q.put(batch)
+                self._batch_queued.set()
+            # if the fetch overran its deadline, the next one starts right away and the schedule continues from there instead of catching up on missed fetches
+            next_fetch = max(next_fetch, time.monotonic())
+
+    def _append_samples(self, samples):
+        """Append samples to the measurement buffer, doubling its size when it is full"""
+        if len(samples) == 0:
+            return
+        end = self._len + len(samples)
+        if end > self._buf.size:
+            size = self._buf.size
+            while size < end:
+                size *= 2
+            buf = np.empty(size, dtype=np.float32)
+            buf[:self._len] = self._buf[:self._len]
+            self._buf = buf
+        # the samples are converted to float32 while being copied into the buffer, without an intermediate array
+        batch = self._buf[self._len:end]
+        batch[:] = samples
+        self._len = end
+
+        self._sum += float(batch.sum(dtype=np.float64))  # pairwise summation in float64 is accurate enough, no need for math.fsum
+        batch_min, batch_max = float(batch.min()), float(batch.max())
+        self._min = min(self._min, batch_min)
+        self._max = max(self._max, batch_max)
+
+    def _reset_samples(self):
+        """Clear the measurement buffer and running statistics"""
+        # a new buffer is used so that views returned by current_measurements keep the previous measurement
+        self._buf = np.empty(1 << 16, dtype=np.float32)
+        self._len = 0
+        self._sum = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+
+    @property
+    def current_measurements(self):
+        """Current measurements in uA of the last measurement"""
+        return self._buf[:self._len]
 
     def _average_samples(self, list, window_size):
         """Average samples based on window size"""
-        chunks = [list[val:val + window_size] for val in range(0, len(list), window_size)]
-        avgs = []
-        for chunk in chunks:
-            avgs.append(sum(chunk) / len(chunk))
+        samples = np.asarray(list, dtype=np.float64)
+        n = (len(samples) // window_size) * window_size  # number of samples that fill whole windows
+        avgs = samples[:n].reshape(-1, window_size).mean(axis=1)
+        if n < len(samples):
+            avgs = np.append(avgs, samples[n:].mean())  # last, partial window
+
+        return avgs.tolist()
 
-        return avgs
+    @property
+    def measuring(self):
+        """True while measuring"""
+        return self._running.is_set()
 
     def start_measuring(self):
         """Start measuring"""
-        with self.measure_lock:  
+        with self._dev_lock:
             if not self.measuring:  # toggle measuring flag only if currently not measuring
-                self.current_measurements = []  # reset current measurements
-                self.measure_lock.release()
-                self.measuring = True  # set internal flag
+                with self._data_lock:
+                    self._reset_samples()  # reset current measurements
                 self.ppk2.start_measuring()  # send command to ppk2
                 self.measurement_start_time = time.time()
+                self._running.set()  # let the measurement thread fetch data
+                with self._wakeup:
+                    self._wakeup.notify_all()
 
-    def stop_measuring(self):
-        """Stop measuring"""
-        with self.measure_lock:
-            self.measuring = False
-            self.measure_lock.acquire()
+    def _stop_measuring(self):
+        with self._dev_lock:
+            self._running.clear()  # the measurement thread checks this while holding _dev_lock, so it won't fetch again
             self.measurement_stop_time = time.time()
             self.ppk2.stop_measuring()  # send command to ppk2
 
-            if self.filename is not None:
-                self.write_csv_rows(self.current_measurements)
+    def stop_measuring(self):
+        """Stop measuring, returns when all data is written to the csv file and raises an IOError if writing it failed"""
+        self._stop_measuring()
+
+        if self._writer_thread is not None:
+            self._batch_queued.wait()
+            self._write_q.join()
+            # the error is reported once, the next measurement is written to the file again
+            error, self._writer_error = self._writer_error, None
+            if error is not None:
+                raise IOError(f"Error writing to {self.filename}") from error
+
+    def get_min_max_current_mA(self):
+        """Returns minimum and maximum current of last measurement in mA"""
+        with self._data_lock:
+            if self._len == 0:
+                raise ValueError("No measurements")
+            return self._min / 1000, self._max / 1000
 
     def get_min_current_mA(self):
-        with self.measure_lock:
-            return min(self.current_measurements) / 1000
+        return self.get_min_max_current_mA()[0]
 
     def get_max_current_mA(self):
-        with self.measure_lock:
-            return max(self.current_measurements) / 1000
+        return self.get_min_max_current_mA()[1]
 
     def get_num_measurements(self):
-        with self.measure_lock:
-            return len(self.current_measurements)
+        with self._data_lock:
+            return self._len
 
     def get_average_current_mA(self):
         """Returns average current of last measurement in mA"""
-        with self.measure_lock:
-            if len(self.current_measurements) == 0:
+        with self._data_lock:
+            if self._len == 0:
                 return 0
 
-            average_current_mA = (sum(self.current_measurements) / len(self.current_measurements)) / 1000 # measurements are in microamperes, divide by 1000
+            average_current_mA = (self._sum / self._len) / 1000 # measurements are in microamperes, divide by 1000
             return average_current_mA
 
     def get_average_power_consumption_mWh(self):
         """Return average power consumption of last measurement in mWh"""
-        with self.measure_lock:
-            average_current_mA = self.get_average_current_mA()
-            average_power_mW = (self.source_voltage_mV / 1000) * average_current_mA  # divide by 1000 as source voltage is in millivolts - this gives us milliwatts
-            measurement_duration_h = self.get_measurement_duration_s() / 3600  # duration in seconds, divide by 3600 to get hours
-            average_consumption_mWh = average_power_mW * measurement_duration_h
-            return average_consumption_mWh
+        average_current_mA = self.get_average_current_mA()
+        average_power_mW = (self.source_voltage_mV / 1000) * average_current_mA  # divide by 1000 as source voltage is in millivolts - this gives us milliwatts
+        measurement_duration_h = self.get_measurement_duration_s() / 3600  # duration in seconds, divide by 3600 to get hours
+        average_consumption_mWh = average_power_mW * measurement_duration_h
+        return average_consumption_mWh
 
     def get_average_charge_mC(self):
         """Returns average charge in milli coulomb"""
-        with self.measure_lock:
-            average_current_mA = self.get_average_current_mA()
-            measurement_duration_s = self.get_measurement_duration_s()  # in seconds
-            return average_current_mA * measurement_duration_s
+        average_current_mA = self.get_average_current_mA()
+        measurement_duration_s = self.get_measurement_duration_s()  # in seconds
+        return average_current_mA * measurement_duration_s
 
     def get_measurement_duration_s(self):
         """Returns duration of measurement"""
@@ -7,6 +7,7 @@ The official nRF Connect Power Profiler was used as a reference: https://github.
 import time
 import serial
 import struct
+import numpy as np
 import logging
 import os
 import queue
@@ -68,6 +69,8 @@ class PPK2_API():
             "HW": None,
             "IA": None
         }
+        # per-range numpy arrays of the modifiers used by _calibrate(), rebuilt after the modifiers are read from the device
+        self._modifier_arrays = None
 
         self.vdd_low = 800
         self.vdd_high = 5000
@@ -161,6 +164,7 @@ class PPK2_API():
     def _parse_metadata(self, metadata):
         """Parse metadata and store it to modifiers"""
         # TODO handle more robustly
+        self._modifier_arrays = None
         try:
             data_split = [row.split(": ") for row in metadata.split("\n")]
 
@@ -187,25 +191,11 @@ class PPK2_API():
         pos = pos
         mask = ((2**bits-1) << pos)
         mask = self._twos_comp(mask)
-        return {"mask": mask, "pos": pos}
+        return {"mask": mask, "pos": pos, "bits": bits}
 
-    def _get_masked_value(self, value, meas, is_bits=False):
-        masked_value = (value & meas["mask"]) >> meas["pos"]
-        return masked_value
-
-    def _handle_raw_data(self, adc_value):
-        """Convert raw value to analog value"""
-        try:
-            current_measurement_range = min(self._get_masked_value(
-                adc_value, self.MEAS_RANGE), 4)  # 5 is the number of parameters
-            adc_result = self._get_masked_value(adc_value, self.MEAS_ADC) * 4
-            bits = self._get_masked_value(adc_value, self.MEAS_LOGIC)
-            analog_value = self.get_adc_result(
-                current_measurement_range, adc_result) * 10**6
-            return analog_value, bits
-        except Exception as e:
-            print("Measurement outside of range!")
-            return None, None
+    def _extract_field(self, raw, meas):
+        """Extract the field described by a mask from an array of raw readings"""
+        return (raw >> meas["pos"]) & ((1 << meas["bits"]) - 1)
 
     @staticmethod
     def list_devices():
@@ -275,54 +265,22 @@ class PPK2_API():
         self._write_serial((PPK2_Command.SET_POWER_MODE,
                             PPK2_Command.AVG_NUM_SET))  # 17,2
 
+    def _calibrate(self, current_ranges, adc_values):
+        """Convert adc results to currents in A using the modifiers of their measurement ranges, works on arrays and single values"""
+        if self._modifier_arrays is None:
+            self._modifier_arrays = {key: np.array([self.modifiers[key][str(i)] for i in range(5)], dtype=np.float64)
+                                     for key in ("R", "GS", "GI", "O", "S", "I", "UG")}
+        modifiers = self._modifier_arrays
+        result_without_gain = (adc_values - modifiers["O"][current_ranges]) * (
+            self.adc_mult / modifiers["R"][current_ranges])
+        return modifiers["UG"][current_ranges] * (result_without_gain * (modifiers["GS"][current_ranges] * result_without_gain + modifiers["GI"][current_ranges]) + (
+            modifiers["S"][current_ranges] * (self.current_vdd / 1000) + modifiers["I"][current_ranges]))
+
     def get_adc_result(self, current_range, adc_value):
         """Get result of adc conversion"""
-        current_range = str(current_range)
-        result_without_gain = (adc_value - self.modifiers["O"][current_range]) * (
-            self.adc_mult / self.modifiers["R"][current_range])
-        adc = self.modifiers["UG"][current_range] * (result_without_gain * (self.modifiers["GS"][current_range] * result_without_gain + self.modifiers["GI"][current_range]) + (
-            self.modifiers["S"][current_range] * (self.current_vdd / 1000) + self.modifiers["I"][current_range]))
-
-        prev_rolling_avg = self.rolling_avg
-        prev_rolling_avg4 = self.rolling_avg4
-
-        # spike filtering / rolling average
-        if self.rolling_avg is None:
-            self.rolling_avg = adc
-        else:
-            self.rolling_avg = self.spike_filter_alpha * adc + (1 - self.spike_filter_alpha) * self.rolling_avg
-        
-        if self.rolling_avg4 is None:
-            self.rolling_avg4 = adc
-        else:
-            self.rolling_avg4 = self.spike_filter_alpha5 * adc + (1 - self.spike_filter_alpha5) * self.rolling_avg4
-
-        if self.prev_range is None:
-            self.prev_range = current_range
-
-        if self.prev_range != current_range or self.after_spike > 0:
-            if self.prev_range != current_range:
-                self.consecutive_range_samples = 0
-                self.after_spike = self.spike_filter_samples
-            else:
-                self.consecutive_range_samples += 1
-
-            if current_range == "4":
-                if self.consecutive_range_samples < 2:
-                    self.rolling_avg = prev_rolling_avg
-                    self.rolling_avg4 = prev_rolling_avg4
-                adc = self.rolling_avg4
-            else:
-                adc = self.rolling_avg
-            
-            self.after_spike -= 1
-
-        self.prev_range = current_range
-        return adc
-
-    def _digital_to_analog(self, adc_value):
-        """Convert discrete value to analog value"""
-        return int.from_bytes(adc_value, byteorder="little", signed=False)  # convert reading to analog value
+        current_range = int(current_range)
+        adc = float(self._calibrate(current_range, adc_value))
+        return self._filter_spikes([adc], [current_range])[0]
 
     def digital_channels(self, bits):
         """
@@ -344,6 +302,81 @@ class PPK2_API():
             digital_channels[7].append((sample & 128) >> 7)
         return digital_channels
 
+    def _filter_spikes(self, adc_values, current_ranges):
+        """Apply the spike filter / rolling average to a sequence of calibrated adc results and their measurement ranges"""
+        alpha = self.spike_filter_alpha
+        alpha5 = self.spike_filter_alpha5
+        rolling_avg = self.rolling_avg
+        rolling_avg4 = self.rolling_avg4
+        prev_range = self.prev_range
+        consecutive_range_samples = self.consecutive_range_samples
+        after_spike = self.after_spike
+
+        filtered = []
+        for adc, current_range in zip(adc_values, current_ranges):
+            prev_rolling_avg = rolling_avg
+            prev_rolling_avg4 = rolling_avg4
+
+            rolling_avg = adc if rolling_avg is None else alpha * adc + (1 - alpha) * rolling_avg
+            rolling_avg4 = adc if rolling_avg4 is None else alpha5 * adc + (1 - alpha5) * rolling_avg4
+
+            if prev_range is None:
+                prev_range = current_range
+
+            if prev_range != current_range or after_spike > 0:
+                if prev_range != current_range:
+                    consecutive_range_samples = 0
+                    after_spike = self.spike_filter_samples
+                else:
+                    consecutive_range_samples += 1
+
+                if current_range == 4:
+                    if consecutive_range_samples < 2:
+                        rolling_avg = prev_rolling_avg
+                        rolling_avg4 = prev_rolling_avg4
+                    adc = rolling_avg4
+                else:
+                    adc = rolling_avg
+
+                after_spike -= 1
+
+            prev_range = current_range
+            filtered.append(adc)
+
+        self.rolling_avg = rolling_avg
+        self.rolling_avg4 = rolling_avg4
+        self.prev_range = prev_range
+        self.consecutive_range_samples = consecutive_range_samples
+        self.after_spike = after_spike
+        return filtered
+
+    def get_samples_array(self, buf):
+        """
+        Same as get_samples(), but returns the samples and raw digital outputs as numpy arrays.
+        The raw readings are decoded and calibrated vectorized, only the spike filter is applied sample by sample.
+        """
+        data = self.remainder["sequence"] + buf
+        sample_size = 4  # one analog value is 4 bytes in size
+        end = len(data) - len(data) % sample_size
+
+        self.remainder["sequence"] = data[end:]
+        self.remainder["len"] = len(data) - end
+
+        raw = np.frombuffer(data, dtype="<u4", count=end // sample_size)
+        current_ranges = np.minimum(self._extract_field(raw, self.MEAS_RANGE), 4)  # 5 is the number of parameters
+        adc_results = self._extract_field(raw, self.MEAS_ADC).astype(np.int64) * 4
+        raw_digital_output = self._extract_field(raw, self.MEAS_LOGIC)
+
+        try:
+            adc = self._calibrate(current_ranges, adc_results)
+        except Exception as e:
+            # the calibration fails the same way for every sample, e.g. when the source voltage was not set yet
+            logging.error(f"An error occured when converting samples, dropping {len(raw)} samples: {e}")
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.uint32)
+
+        samples = np.array(self._filter_spikes(adc.tolist(), current_ranges.tolist()), dtype=np.float64) * 10**6
+        return samples, raw_digital_output
+
     def get_samples(self, buf):
         """
         Returns list of samples read in one sampling period.
@@ -351,39 +384,11 @@ class PPK2_API():
         Manipulation of samples is left to the user.
         See example for more info.
         """
-
-        sample_size = 4  # one analog value is 4 bytes in size
-        offset = self.remainder["len"]
-        samples = []
-        raw_digital_output = []
-
-        first_reading = (
-            self.remainder["sequence"] + buf[0:sample_size-offset])[:4]
-        adc_val = self._digital_to_analog(first_reading)
-        measurement, bits = self._handle_raw_data(adc_val)
-        if measurement is not None:
-            samples.append(measurement)
-        if bits is not None:
-            raw_digital_output.append(bits)
-
-        offset = sample_size - offset
-
-        while offset <= len(buf) - sample_size:
-            next_val = buf[offset:offset + sample_size]
-            offset += sample_size
-            adc_val = self._digital_to_analog(next_val)
-            measurement, bits = self._handle_raw_data(adc_val)
-            if measurement is not None:
-                samples.append(measurement)
-            if bits is not None:
-                raw_digital_output.append(bits)
-
-        self.remainder["sequence"] = buf[offset:len(buf)]
-        self.remainder["len"] = len(buf)-offset
+        samples, raw_digital_output = self.get_samples_array(buf)
 
         # return list of samples and raw digital outputs
         # handle those lists in PPK2 API wrapper
-        return samples, raw_digital_output  
+        return samples.tolist(), raw_digital_output.tolist()
 
 
 class PPK_Fetch(threading.Thread):